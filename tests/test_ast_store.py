@@ -0,0 +1,514 @@
+"""test.ipynb に内蔵された ast_store ツールのテスト。"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+pydantic = pytest.importorskip("pydantic")
+langchain_tools = pytest.importorskip("langchain_core.tools")
+
+NOTEBOOK = Path(__file__).resolve().parent.parent / "test.ipynb"
+
+
+def _load_namespace():
+    """ast_store を定義しているセルを新しい名前空間で実行する（プロセス再起動の代わり）。"""
+    nb = json.loads(NOTEBOOK.read_text(encoding="utf-8"))
+    src = next(
+        "".join(cell["source"])
+        for cell in nb["cells"]
+        if cell["cell_type"] == "code" and "def ast_store(" in "".join(cell["source"])
+    )
+    ns = {
+        "__name__": "ast_store_cell",
+        "os": os,
+        "BaseModel": pydantic.BaseModel,
+        "Field": pydantic.Field,
+        "tool": langchain_tools.tool,
+    }
+    exec(compile(src, str(NOTEBOOK), "exec"), ns)
+    return ns
+
+
+def _load_store():
+    return _load_namespace()["ast_store"]
+
+
+def _call(store, **kwargs):
+    return json.loads(store.invoke(kwargs))
+
+
+def _append(store, ast_path, title):
+    meta = _call(store, action="load_meta", ast_path=ast_path, purpose="append_child", node_path=[])
+    result = _call(
+        store,
+        action="append_child",
+        ast_path=ast_path,
+        parent_path=[],
+        section_title=title,
+        content_summary="",
+        edit_token=meta["edit_token"],
+    )
+    assert result["ok"], result
+    return result
+
+
+def _tear_journal(ast_path):
+    with open(f"{ast_path}.journal", "ab") as f:
+        f.write(b'{"op":"insert","args":{"parent_pa')
+
+
+def _children_titles(store, ast_path):
+    loaded = _call(store, action="load", ast_path=ast_path)
+    return loaded["rev"], [c["section_title"] for c in loaded["ast"]["root"]["children"]]
+
+
+def test_torn_journal_tail_is_dropped_after_restart(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    store = _load_store()
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+    _append(store, ast_path, "A")
+    _tear_journal(ast_path)
+
+    store = _load_store()
+    _append(store, ast_path, "B")
+    _append(store, ast_path, "C")
+
+    assert _children_titles(_load_store(), ast_path) == (3, ["A", "B", "C"])
+
+
+def test_torn_journal_tail_in_running_process(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    store = _load_store()
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+    _append(store, ast_path, "A")
+    _tear_journal(ast_path)
+    _append(store, ast_path, "B")
+
+    with open(f"{ast_path}.journal", "rb") as f:
+        assert all(line.endswith(b"\n") for line in f)
+    assert _children_titles(_load_store(), ast_path) == (2, ["A", "B"])
+
+
+def test_evicted_ast_releases_side_caches(tmp_path):
+    ns = _load_namespace()
+    ns["_AST_CACHE_MAX"] = 4
+    store = ns["ast_store"]
+    paths = [str(tmp_path / f"doc{i}.ast.json") for i in range(10)]
+    for ast_path in paths:
+        assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+        _append(store, ast_path, "A")
+        assert _call(store, action="find_by_title", ast_path=ast_path, title_query="a")["matches"]
+        assert _call(store, action="load_subtree", ast_path=ast_path, node_path=[0])["ok"]
+
+    cached = {id(entry[3]) for entry in ns["_AST_CACHE"].values()}
+    assert len(cached) == 4
+    assert set(ns["_PATH_INDEX"]) <= cached
+    assert set(ns["_TITLE_SEARCH_INDEX"]) == cached
+    # 各 AST はルートと子1つの2ノード
+    assert len(ns["_SUBTREE_CACHE"]) <= 2 * 4
+
+
+def test_load_subtree_on_small_file_populates_cache(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    assert _call(_load_store(), action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+
+    ns = _load_namespace()
+    assert _call(ns["ast_store"], action="load_subtree", ast_path=ast_path, node_path=[])["ok"]
+    assert os.path.abspath(ast_path) in ns["_AST_CACHE"]
+
+
+def test_leftover_journal_is_not_replayed_onto_a_new_document(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    store = _load_store()
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+    _append(store, ast_path, "A")
+    _append(store, ast_path, "B")
+
+    # ノートブックの実行セルと同じく、本体だけを消して rev 0 の JSON を書き直す
+    os.remove(ast_path)
+    with open(ast_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "file_name": "new.txt",
+                "__meta__": {"rev": 0, "updated_at": None},
+                "root": {"section_title": "new", "content_summary": "", "children": []},
+            },
+            f,
+        )
+
+    store = _load_store()
+    assert _children_titles(store, ast_path) == (0, [])
+    _append(store, ast_path, "C")
+    assert _children_titles(_load_store(), ast_path) == (1, ["C"])
+
+
+def test_load_does_not_modify_a_torn_journal(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    store = _load_store()
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+    _append(store, ast_path, "A")
+    _tear_journal(ast_path)
+    with open(f"{ast_path}.journal", "rb") as f:
+        before = f.read()
+
+    assert _children_titles(_load_store(), ast_path) == (1, ["A"])
+    with open(f"{ast_path}.journal", "rb") as f:
+        assert f.read() == before
+
+
+def test_corrupt_journal_line_is_reported(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    store = _load_store()
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+    _append(store, ast_path, "A")
+    _append(store, ast_path, "B")
+    with open(f"{ast_path}.journal", "rb") as f:
+        first, second = f.readlines()
+    with open(f"{ast_path}.journal", "wb") as f:
+        f.write(first + b'{"op":"ins\n' + second)
+
+    result = _call(_load_store(), action="load", ast_path=ast_path)
+    assert not result["ok"]
+    assert "ジャーナルが破損しています" in result["error"]
+
+
+def test_title_search_index_follows_appends(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    ns = _load_namespace()
+    store = ns["ast_store"]
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+    _append(store, ast_path, "Chapter A")
+
+    def find(query, max_results=20):
+        result = _call(store, action="find_by_title", ast_path=ast_path, title_query=query, max_results=max_results)
+        return [m["path"] for m in result["matches"]]
+
+    # 1回目は走査、2回目でインデックスを作る
+    assert find("CHAPTER") == [[0]]
+    assert find("CHAPTER") == [[0]]
+    ast = ns["_AST_CACHE"][os.path.abspath(ast_path)][3]
+    search = ns["_TITLE_SEARCH_INDEX"][id(ast)]
+
+    _append(store, ast_path, "Chapter B")
+    meta = _call(store, action="load_meta", ast_path=ast_path, purpose="ensure_path", node_titles=[])
+    assert _call(
+        store,
+        action="ensure_path",
+        ast_path=ast_path,
+        node_titles=["Chapter A", "chapter A.1"],
+        create_missing=True,
+        edit_token=meta["edit_token"],
+    )["ok"]
+
+    # 末尾への追加ではインデックスを作り直さず、結果は先行順のまま
+    assert ns["_TITLE_SEARCH_INDEX"][id(ast)] is search
+    assert find("chapter") == [[0], [0, 0], [1]]
+    assert find("chapter", max_results=2) == [[0], [0, 0]]
+    assert find("Chapter") == [m["path"] for m in ns["_scan_nodes_by_title"](ast, "Chapter", max_results=20, case_sensitive=False)]
+
+    # タイトルの変更では作り直す
+    meta = _call(store, action="load_meta", ast_path=ast_path, purpose="update_node", node_path=[1])
+    assert _call(
+        store, action="update_node", ast_path=ast_path, node_path=[1], section_title="Appendix", edit_token=meta["edit_token"]
+    )["ok"]
+    assert id(ast) not in ns["_TITLE_SEARCH_INDEX"]
+    assert find("chapter") == [[0], [0, 0]]
+
+
+def test_subtree_cache_stays_within_file_size(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    ns = _load_namespace()
+    ns["_SUBTREE_CACHE_NODE_BYTES"] = 300
+    store = ns["ast_store"]
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+    for chapter in range(3):
+        for section in range(4):
+            meta = _call(store, action="load_meta", ast_path=ast_path, purpose="ensure_path", node_titles=[])
+            assert _call(
+                store,
+                action="ensure_path",
+                ast_path=ast_path,
+                node_titles=[f"Chapter {chapter}", f"Section {chapter}.{section}"],
+                create_missing=True,
+                created_default_summary="x" * 40,
+                edit_token=meta["edit_token"],
+            )["ok"]
+        assert _call(store, action="compact", ast_path=ast_path)["ok"]
+
+        cached = ns["_SUBTREE_CACHE"].values()
+        assert cached
+        assert sum(len(buf) for _node, buf in cached) <= os.path.getsize(ast_path)
+        assert all(len(buf) <= 300 for _node, buf in cached)
+
+    with open(ast_path, "rb") as f:
+        on_disk = json.load(f)
+    assert on_disk == _call(_load_store(), action="load", ast_path=ast_path)["ast"]
+
+
+def _write_ast(ast_path, ast):
+    with open(ast_path, "w", encoding="utf-8") as f:
+        json.dump(ast, f, ensure_ascii=False)
+
+
+def _stream_and_full_subtrees(ast_path, node_paths):
+    """ストリーミング（閾値 0）と全体読み込みの load_subtree 応答を並べて返す。"""
+    stream_ns = _load_namespace()
+    stream_ns["_STREAM_SUBTREE_BYTES"] = 0
+    streamed = []
+    stream_subtree = stream_ns["_stream_subtree"]
+
+    def spy(*args):
+        streamed.append(args)
+        return stream_subtree(*args)
+
+    stream_ns["_stream_subtree"] = spy
+    full_store = _load_store()
+    pairs = [
+        (
+            _call(stream_ns["ast_store"], action="load_subtree", ast_path=ast_path, node_path=node_path),
+            _call(full_store, action="load_subtree", ast_path=ast_path, node_path=node_path),
+        )
+        for node_path in node_paths
+    ]
+    assert len(streamed) == len(node_paths)
+    return pairs
+
+
+def _node(title, *children, **fields):
+    return {"section_title": title, "content_summary": f"{title} の要約", **fields, "children": list(children)}
+
+
+def test_streamed_subtree_matches_full_load(tmp_path):
+    pytest.importorskip("ijson")
+    ast_path = str(tmp_path / "doc.ast.json")
+    _write_ast(
+        ast_path,
+        {
+            "file_name": "doc.txt",
+            "__meta__": {"rev": 7, "updated_at": "2024-01-01T00:00:00+00:00"},
+            "root": _node(
+                "doc.txt",
+                _node("第1章", _node("1.1", score=1.5, tags=["a", {"b": None}])),
+                _node("第2章", _node("2.1"), _node("2.2", _node("2.2.1", flag=True))),
+                {"section_title": "葉", "content_summary": ""},
+            ),
+        },
+    )
+    paths = [[], [0], [0, 0], [1], [1, 1], [1, 1, 0], [2]]
+    for streamed, full in _stream_and_full_subtrees(ast_path, paths):
+        assert streamed["ok"], streamed
+        assert streamed == full
+
+
+def test_streamed_subtree_reports_bad_paths_like_full_load(tmp_path):
+    pytest.importorskip("ijson")
+    ast_path = str(tmp_path / "doc.ast.json")
+    _write_ast(
+        ast_path,
+        {
+            "file_name": "doc.txt",
+            "__meta__": {"rev": 1, "updated_at": None},
+            "root": _node("doc.txt", _node("A", _node("A.1")), "not a node", {"section_title": "B"}),
+        },
+    )
+    # 範囲外、負のインデックス、dict でない子、children の無いノードの下
+    paths = [[3], [0, 1], [0, 0, 0], [-1], [1], [1, 0], [2, 0]]
+    for streamed, full in _stream_and_full_subtrees(ast_path, paths):
+        assert not streamed["ok"]
+        assert streamed == full
+
+
+def test_streamed_subtree_without_meta(tmp_path):
+    pytest.importorskip("ijson")
+    ast_path = str(tmp_path / "doc.ast.json")
+    _write_ast(ast_path, {"file_name": "doc.txt", "root": _node("doc.txt", _node("A"))})
+    for streamed, full in _stream_and_full_subtrees(ast_path, [[], [0]]):
+        assert streamed["ok"], streamed
+        assert (streamed["rev"], streamed["updated_at"]) == (0, None)
+        assert streamed == full
+
+    # __meta__ が root より後ろにあっても拾う
+    _write_ast(ast_path, {"root": _node("doc.txt", _node("A")), "__meta__": {"rev": 3, "updated_at": "T"}})
+    for streamed, full in _stream_and_full_subtrees(ast_path, [[0]]):
+        assert (streamed["rev"], streamed["updated_at"]) == (3, "T")
+        assert streamed == full
+
+
+def _token(store, ast_path, purpose, **target):
+    return _call(store, action="load_meta", ast_path=ast_path, purpose=purpose, **target)["edit_token"]
+
+
+def _disk_state(ast_path):
+    contents = []
+    for path in (ast_path, f"{ast_path}.journal"):
+        try:
+            with open(path, "rb") as f:
+                contents.append(f.read())
+        except FileNotFoundError:
+            contents.append(None)
+    return contents
+
+
+def test_batch_bumps_rev_once_and_checks_tokens_at_start_rev(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    store = _load_store()
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+    _append(store, ast_path, "A")
+
+    # どのトークンも batch 開始時点の rev=1 で発行する
+    tokens = [_token(store, ast_path, "append_child", node_path=[]) for _ in range(2)]
+    tokens.append(_token(store, ast_path, "append_to_summary", node_path=[0]))
+    result = _call(
+        store,
+        action="batch",
+        ast_path=ast_path,
+        ops=[
+            {"action": "append_child", "parent_path": [], "section_title": "B", "content_summary": "", "edit_token": tokens[0]},
+            {"action": "append_child", "parent_path": [], "section_title": "C", "content_summary": "", "edit_token": tokens[1]},
+            {"action": "append_to_summary", "node_path": [0], "append_text": "追記", "edit_token": tokens[2]},
+        ],
+    )
+    assert result["ok"], result
+    assert result["rev"] == 2
+    assert all(r["ok"] for r in result["results"])
+
+    fresh = _load_store()
+    assert _children_titles(fresh, ast_path) == (2, ["A", "B", "C"])
+    assert _call(fresh, action="load_subtree", ast_path=ast_path, node_path=[0])["node"]["content_summary"] == "追記"
+
+
+def test_failed_batch_op_rolls_back_everything(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    ns = _load_namespace()
+    store = ns["ast_store"]
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+    _append(store, ast_path, "A")
+    before = _disk_state(ast_path)
+
+    tokens = [_token(store, ast_path, "append_child", node_path=[]) for _ in range(2)]
+    result = _call(
+        store,
+        action="batch",
+        ast_path=ast_path,
+        ops=[
+            {"action": "append_child", "parent_path": [], "section_title": "B", "content_summary": "", "edit_token": tokens[0]},
+            {"action": "append_child", "parent_path": [], "section_title": "C", "position": 99, "edit_token": tokens[1]},
+        ],
+    )
+    assert not result["ok"]
+    assert result["failed_index"] == 1
+    assert result["rev"] == 1
+    assert [r["ok"] for r in result["results"]] == [True, False]
+
+    # 途中まで変更したキャッシュは捨て、ディスクには何も書かない
+    assert os.path.abspath(ast_path) not in ns["_AST_CACHE"]
+    assert _disk_state(ast_path) == before
+    assert _children_titles(store, ast_path) == (1, ["A"])
+    assert _children_titles(_load_store(), ast_path) == (1, ["A"])
+
+
+def _append_retrying(store, ast_path, title):
+    """古いトークンで弾かれたら load_meta からやり直して子を追加する。"""
+    while True:
+        meta = _call(store, action="load_meta", ast_path=ast_path, purpose="append_child", node_path=[])
+        result = _call(
+            store,
+            action="append_child",
+            ast_path=ast_path,
+            parent_path=[],
+            section_title=title,
+            content_summary="",
+            edit_token=meta["edit_token"],
+        )
+        if result["ok"] or "古いトークン" not in result["error"]:
+            return result
+
+
+def _run_threads(count, target):
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(i):
+        barrier.wait()
+        results[i] = target(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_coalesced_writes_all_survive_restart(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    ns = _load_namespace()
+    ns["_COALESCE_S"] = 0.02
+    store = ns["ast_store"]
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+
+    titles = [f"T{i}" for i in range(8)]
+    results = _run_threads(len(titles), lambda i: _append_retrying(store, ast_path, titles[i]))
+    assert all(r["ok"] for r in results), results
+
+    rev, children = _children_titles(_load_store(), ast_path)
+    assert rev == len(titles)
+    assert sorted(children) == titles
+
+
+def test_coalesced_append_error_reaches_every_waiter(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    ns = _load_namespace()
+    ns["_COALESCE_S"] = 0.5
+    store = ns["ast_store"]
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+
+    calls = []
+
+    def failing_append(*args):
+        calls.append(args)
+        raise OSError("disk full")
+
+    ns["_append_journal"] = failing_append
+    results = _run_threads(6, lambda i: _append_retrying(store, ast_path, f"T{i}"))
+
+    assert all(not r["ok"] and "disk full" in r["error"] for r in results), results
+    assert 0 < len(calls) < len(results)
+    assert _children_titles(_load_store(), ast_path) == (0, [])
+
+
+def test_load_flushes_pending_journal_lines(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    ns = _load_namespace()
+    ns["_COALESCE_S"] = 0.5
+    store = ns["ast_store"]
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+
+    writer_result = []
+    writer = threading.Thread(target=lambda: writer_result.append(_append(store, ast_path, "A")))
+    writer.start()
+    deadline = time.monotonic() + 5
+    while os.path.abspath(ast_path) not in ns["_PENDING_JOURNALS"]:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+    # まとめ役が待っている間にキャッシュを失っても、読み込み時にまとめ待ちの行を書き出して反映する
+    ns["_cache_drop"](ast_path)
+    assert _children_titles(store, ast_path) == (1, ["A"])
+    writer.join()
+    assert writer_result[0]["ok"]
+    assert _children_titles(_load_store(), ast_path) == (1, ["A"])
+
+
+def test_batch_rejects_load_subtree(tmp_path):
+    ast_path = str(tmp_path / "doc.ast.json")
+    store = _load_store()
+    assert _call(store, action="init", ast_path=ast_path, file_name="doc.txt")["ok"]
+
+    result = _call(store, action="batch", ast_path=ast_path, ops=[{"action": "load_subtree", "node_path": []}])
+    assert not result["ok"]
+    assert result["failed_index"] == 0
+    assert "load_subtree" in result["error"]